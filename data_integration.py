@@ -1,438 +1,926 @@
-# For handling dates and times.
-import datetime
-
-# For accessing the names of months.
-from calendar import month_name
-
-# For handling authentication with Google services.
-from google.oauth2 import service_account
-
-# For accessing Google Analytics data.
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-
-# To configure and run reports on Google Analytics.
-from google.analytics.data_v1beta.types import (
-    RunReportRequest,
-    DateRange,
-    Dimension,
-    Metric,
-)
-
-# To create service objects for Google APIs.
-from googleapiclient.discovery import build
-
-# For logging messages.
-import logging
-
-# Defining the scopes required for the Google API access:
-# Sheets, Google Analytics, and Google Search Console.
-
-SCOPES = [
-    # Read/write access to user sheets.
-    'https://www.googleapis.com/auth/spreadsheets',
-    # Read-only access to Google Analytics data.
-    'https://www.googleapis.com/auth/analytics.readonly',
-    # Read-only access to Google Webmasters data.
-    'https://www.googleapis.com/auth/webmasters.readonly',
-]
-
-# Path to the service account credentials JSON file
-# used for authenticating with Google APIs.
-
-SERVICE_ACCOUNT_FILE = 'E:\\Path\\Placeholder\\ServiceAccountFile.json'
-
-# The ID of the Google Sheet where the data will be written.
-SHEET_ID = '1ABc-dEFGhI-Jkl34--mNoPQ'
-
-# Name of the specific worksheet within the Google Sheet where data will be stored.
-SHEET_NAME = '2024'
-
-# The Google Analytics 4 property ID from which the data will be fetched.
-GA4_PROPERTY_ID = 'properties/123456789'
-
-# Logging configuration.
-logging.basicConfig(
-    filename='E:\\Path\\Placeholder\\data_integration.log',
-    level=logging.DEBUG,
-    format='%(asctime)s:%(levelname)s:%(message)s'
-)
-
-
-# Function to fetch data from GA4.
-def fetch_ga4_data(credentials, property_id, start_date, end_date):
-    # Initializing the Google Analytics Data client with the loaded credentials.
-    ga_client = BetaAnalyticsDataClient(credentials=credentials)
-    
-    # Constructing request for metrics.
-    request = RunReportRequest(
-        property=property_id,
-        metrics=[
-            Metric(name='activeUsers'),  # Total number of active users.
-            Metric(name='newUsers'),  # Total number of new users.
-            Metric(name='eventCount'),  # Total number of events.
-            Metric(name='userEngagementDuration'),  # Total engagement time.
-        ],
-        # Date range for the data request.
-        date_ranges=[DateRange(start_date=start_date, end_date=end_date)]
-    )
-
-    # Executing the request using the GA client.
-    response = ga_client.run_report(request)
-
-    # Extracting metrics from the response, defaulting to fallback values
-    # if no data is available.
-    users = (
-        int(response.rows[0].metric_values[0].value) if response.rows else 0
-    )
-    new_users = (
-        int(response.rows[0].metric_values[1].value) if response.rows else 0
-    )
-    events = (
-        int(response.rows[0].metric_values[2].value) if response.rows else 0
-    )
-    engagement_time = (
-        int(response.rows[0].metric_values[3].value) if response.rows else 0
-    )
-    
-    # Request to fetch the number of engaged sessions by different channels.
-    request = RunReportRequest(
-        property=property_id,
-        dimensions=[Dimension(name='sessionDefaultChannelGroup')],
-        metrics=[Metric(name='engagedSessions')],
-        date_ranges=[DateRange(start_date=start_date, end_date=end_date)]
-    )
-
-    # Executing the request using the GA client.
-    response = ga_client.run_report(request)
-    
-    # Initialize channel data with zeros for specified channels.
-    channels = ['Organic Social', 'Direct', 'Organic Search', 'Referral']
-    channel_data = {channel: 0 for channel in channels} 
-    
-    # Processing the response rows to populate the channel data.
-    for row in response.rows:
-        channel = row.dimension_values[0].value
-        if channel in channel_data:
-            channel_data[channel] += int(row.metric_values[0].value)
-    
-    # Creating a list of engaged sessions per channel in the specified order.
-    eng_session_per_channel = [channel_data[channel] for channel in channels]
-
-    # Request to fetch the number of active users for custom events.
-    request = RunReportRequest(
-        property=property_id,
-        dimensions=[Dimension(name='eventName')],
-        metrics=[Metric(name='activeUsers')],
-        date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-        dimension_filter={
-            'filter': {
-                'field_name': 'eventName',
-                'in_list_filter': {
-                    'values': ['user_spent_2_minutes', 'bli_medlem_klick']
-                }
-            }
-        }
-    )
-    
-    # Executing the report.
-    response = ga_client.run_report(request)
-
-    # Variables to store counts.
-    user_spent_2_minutes_user_count = 0
-    bli_medlem_klick_user_count = 0
-
-    # Updating variables based on the response.
-    for row in response.rows:
-        event_name = row.dimension_values[0].value
-        user_count = int(row.metric_values[0].value)
-    
-        if event_name == 'user_spent_2_minutes':
-            user_spent_2_minutes_user_count = int(user_count)
-        elif event_name == 'bli_medlem_klick':
-            bli_medlem_klick_user_count = int(user_count)
-    
-    # Returning all collected data.
-    return (users, new_users, events, engagement_time, eng_session_per_channel,
-            user_spent_2_minutes_user_count, bli_medlem_klick_user_count)
-
-
-# Function to fetch data from Google Search Console.
-def fetch_search_console_data(credentials, site_url, start_date, end_date):
-    # Initializing the Google Search Console service.
-    search_console_service = build(
-        'searchconsole', 'v1', credentials=credentials
-    )
-
-    # Defining the request parameters for the Search Console API query.
-    request = {
-        'startDate': start_date,
-        'endDate': end_date,
-        # No dimensions to collect aggregate data.
-        'dimensions': [],
-        # Letting the API determine the best aggregation method.
-        'aggregationType': 'auto',
-        # Limiting the number of rows returned by the API to 1000.
-        'rowLimit': 1000
-    }
-    
-    # Executing the API query.
-    response = search_console_service.searchanalytics().query(
-        siteUrl=site_url,
-        body=request
-    ).execute()
-
-    if 'rows' in response:
-        # Extracting the first (and only) row of data.
-        totals = response['rows'][0]
-        # Returning the relevant metrics from the response.
-        return (
-            totals['clicks'],
-            totals['impressions'],
-            totals['ctr'],
-            totals['position']
-        )
-    else:
-        # Returning zeros for all metrics if no data is available.
-        return 0, 0, 0, 0
-
-
-# Function to write data to Google Sheets and format CTR.
-def write_and_format_data(credentials, sheet_id, sheet_name, data):
-    # Initializing the Google Sheets API.
-    sheet_service = build('sheets', 'v4', credentials=credentials)
-
-    # Determining the next empty row to write the data to.
-    result = sheet_service.spreadsheets().values().get(
-        spreadsheetId=sheet_id,
-        range=sheet_name
-    ).execute()
-    next_row = len(result.get('values', [])) + 1
-
-    # Defining the cell range to update in A1 notation.
-    range_name = f"{sheet_name}!A{next_row}"
-
-    # Constructing the request body to update the sheet with new data.
-    body = {
-        'values': [data],
-        'majorDimension': 'ROWS'
-    }
-
-    # Updating the values in the specified range of the spreadsheet.
-    result = sheet_service.spreadsheets().values().update(
-        spreadsheetId=sheet_id,
-        range=range_name,
-        valueInputOption='USER_ENTERED',
-        body=body
-    ).execute()
-
-    # The "sheetId" used in Google Sheets API is a unique identifier
-    # assigned to each sheet within a spreadsheet. It is an integer that
-    # remains consistent for a sheet even if the order of sheets is changed
-    # within the spreadsheet.
-
-    # Retrieve the sheet ID for the given sheet name
-    spreadsheet = sheet_service.spreadsheets().get(
-        spreadsheetId=sheet_id
-    ).execute()
-    sheets = spreadsheet.get('sheets', [])
-    sheet_id_num = next(
-        sheet.get('properties', {}).get('sheetId') 
-        for sheet in sheets 
-        if sheet.get('properties', {}).get('title') == sheet_name
-    )
-
-    # Defining a request to format the CTR (Click Through Rate) as a percentage.
-    requests = [{
-        'repeatCell': {
-            'range': {
-                'sheetId': sheet_id_num,  # ID of the sheet.
-                'startRowIndex': next_row - 1,  # Starting at the current row.
-                'endRowIndex': next_row,  # Ending at the next row.
-                'startColumnIndex': 13,  # Starting at column N.
-                'endColumnIndex': 14  # Ending at column O.
-            },
-            'cell': {
-                'userEnteredFormat': {
-                    'numberFormat': {
-                        # Setting number format type to percent.
-                        'type': 'PERCENT',
-                        # Defining the percent format to one decimal place.
-                        'pattern': '#0.0%'
-                    }
-                }
-            },
-            'fields': 'userEnteredFormat.numberFormat'
-        }
-    }]
-
-    # Executing the formatting request to update the cell format.
-    body = {'requests': requests}
-    sheet_service.spreadsheets().batchUpdate(
-        spreadsheetId=sheet_id, body=body
-    ).execute()
-
-
-def main():
-    # Loading service account credentials from JSON file with specified scopes.
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE,
-        scopes=SCOPES
-    )   
-
-    # Getting the current date from the system clock.
-    today = datetime.date.today()
-
-    # URL for analytics data.
-    site_url = 'https://www.ideellmarknadsforing.se/'
-
-    # Computing the first and last day of the previous month.
-    first_day_last_month = (today.replace(day=1)
-                            - datetime.timedelta(days=1)).replace(day=1)
-    last_day_last_month = today.replace(day=1) - datetime.timedelta(days=1)
-
-    # Formatting the month and year (e.g., "May 2024").
-    month_and_year = (
-        f"{month_name[first_day_last_month.month]} {first_day_last_month.year}"
-    )
-
-    # Logging the beginning of the data fetching process for Google Analytics.
-    logging.info("Fetching Google Analytics data")
-
-    # Initializing variables with default values to handle cases where
-    # data might not be fetched.
-
-    users = new_users = events = engagement_time = 0
-    eng_session_per_channel = []
-    formatted_avg_engagement_time = 0
-    user_spent_2_minutes_user_count = bli_medlem_klick_user_count = 0
-    clicks = impressions = ctr = position = 0 
-
-    try:
-        # Attempting to fetch Google Analytics data.
-        (users, new_users, events, engagement_time,
-         eng_session_per_channel, user_spent_2_minutes_user_count,
-         bli_medlem_klick_user_count) = fetch_ga4_data(
-             # Authentication credentials.
-             credentials,
-             # Google Analytics property ID.
-             GA4_PROPERTY_ID,
-             # Start date formatted as string.
-             first_day_last_month.strftime('%Y-%m-%d'),
-             # End date formatted as string.
-             last_day_last_month.strftime('%Y-%m-%d')
-        )
-        
-        # Logging success if data fetching was completed without any exceptions.
-        logging.info("Operation was successful")
-        logging.info(f"GA4 data fetched: users={users}, "
-                     f"new_users={new_users}, "
-                     f"events={events}, "
-                     f"eng_session_per_channel={eng_session_per_channel}")
-        logging.info(f"user_spent_2_minutes={user_spent_2_minutes_user_count}, "
-                     f"bli_medlem_klick={bli_medlem_klick_user_count}")
-
-    except Exception as e:
-        # Logging any exceptions that occur during the fetching process.
-        logging.error("Failed to complete operation", exc_info=True)
-
-    # Logging the beginning of the data fetching process for Google Search Console.
-    logging.info("Fetching Search Console data")
-
-    try:
-        # Attempting to fetch Search Console data.
-        clicks, impressions, ctr, position = fetch_search_console_data(
-            # Authentication credentials.
-            credentials,
-            # URL of the website for which to fetch Search Console data.
-            site_url,
-            # Start date formatted as string.
-            first_day_last_month.strftime('%Y-%m-%d'),
-            # End date formatted as string.
-            last_day_last_month.strftime('%Y-%m-%d')
-        )
-        
-        # Logging success if data fetching was completed without any exceptions.
-        logging.info("Operation was successful")
-        logging.info(f"GSC data fetched: clicks={clicks}, "
-                     f"impressions={impressions}, "
-                     f"ctr={ctr}, "
-                     f"position={position}")
-
-    except Exception as e:
-        # Logging any exceptions that occur during the fetching process.
-        logging.error("Failed to complete operation", exc_info=True)  
-
-    # Preparing data to be written.
-
-    # Logging the beginning of the average engagement time calculation.
-    logging.info("Calculating average engagement time in minutes:seconds")
-
-    try:
-        # Calculating the average engagement time in seconds.
-
-        # Dividing total engagement time by the number of users to get average.
-        avg_engagement_time_seconds = engagement_time / users if users else 0
-
-        # Converting average engagement time from seconds to minutes and seconds.
-        minutes = int(avg_engagement_time_seconds // 60)
-        seconds = int(avg_engagement_time_seconds % 60)
-
-        # Formatting the average engagement time as "minutes:seconds".
-        formatted_avg_engagement_time = f"{minutes}:{seconds:02}"
-            
-        # Logging success message with the calculated average engagement time.
-        logging.info("Operation was successful")
-        logging.info(
-            "Average engagement time: "
-            f"formatted_avg_engagement_time={formatted_avg_engagement_time}"
-        )
-
-    except Exception as e:
-        # Logging an error if there is an exception during the calculation process.
-        logging.error("Failed to complete operation", exc_info=True)
-
-    # Preparing the list of data to be written.
-    data_to_write = (
-        [
-            month_and_year,  # The reporting month and year.
-            users,  # Total number of users.
-            new_users,  # Total number of new users.
-            events,  # Total number of events.
-            formatted_avg_engagement_time,  # Formatted average engagement time.
-        ]
-        + eng_session_per_channel  # Appending engagement sessions per channel data.
-        + [
-            # Number of users who spent at least 2 minutes on the site.
-            user_spent_2_minutes_user_count,
-            # Number of users who clicked the button "Bli medlem".
-            bli_medlem_klick_user_count,
-            # Total number of clicks from Search Console.
-            clicks,
-            # Total number of impressions from Search Console.
-            impressions,
-            # Click-through rate from Search Console.
-            ctr,
-            # Rounded average position from Search Console.
-            round(position, 1),
-        ]
-    )
-
-    # Logging the initiation of the data writing process to Google Sheets.
-    logging.info("Writing to Google Sheets")
-
-    try:
-        # Attempting to write and format the data in Google Sheets.
-        write_and_format_data(credentials, SHEET_ID, SHEET_NAME, data_to_write)
-
-        # Logging a success message if data writing and formatting
-        # complete successfully.
-        logging.info("Operation was successful")
-
-    except Exception as e:
-        # Logging an error message if an exception occurs during
-        # the write operation, including traceback information.
-        logging.error("Failed to complete operation", exc_info=True)
-
-# If the script is executed as the main program, calling the main function.
-if __name__ == '__main__':
-    main()
+# For compact integer accumulators in the report row loops.
+from array import array
+
+# For handling dates and times.
+import datetime
+
+# For accessing the names of months.
+from calendar import month_name
+
+# For running the independent API fetches concurrently.
+from concurrent.futures import ThreadPoolExecutor
+
+# For preserving function metadata on the cache decorator.
+import functools
+
+# For hashing cache keys.
+import hashlib
+
+# For serializing cache keys.
+import json
+
+# For reading the cache mode from the environment.
+import os
+
+# For serializing cached responses.
+import pickle
+
+# For the on-disk response cache.
+import sqlite3
+
+# For timestamping cache entries.
+import time
+
+# For reading command line arguments.
+import sys
+
+# For serializing access to the cache database across threads.
+import threading
+
+# For running the pipeline on a schedule inside a long-lived process.
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+# For handling authentication with Google services.
+from google.oauth2 import service_account
+
+# For accessing Google Analytics data.
+from google.analytics.data_v1beta import BetaAnalyticsDataClient
+
+# To configure and run reports on Google Analytics.
+from google.analytics.data_v1beta.types import (
+    BatchRunReportsRequest,
+    RunReportRequest,
+    DateRange,
+    Dimension,
+    Metric,
+)
+
+# To create service objects for Google APIs.
+from googleapiclient.discovery import build
+
+# For detecting stale cached sheet IDs on API errors.
+from googleapiclient.errors import HttpError
+
+# For classifying errors raised by the GA4 (gRPC) client.
+from google.api_core.exceptions import GoogleAPICallError
+
+# For retrying transient API failures with exponential backoff.
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+# For flushing the log queue at interpreter exit.
+import atexit
+
+# For logging messages.
+import logging
+
+# For moving log writes off the main thread.
+from logging.handlers import QueueHandler, QueueListener
+
+# For the queue between the loggers and the log listener thread.
+import queue
+
+# Defining the scopes required for the Google API access:
+# Sheets, Google Analytics, and Google Search Console.
+
+SCOPES = [
+    # Read/write access to user sheets.
+    'https://www.googleapis.com/auth/spreadsheets',
+    # Read-only access to Google Analytics data.
+    'https://www.googleapis.com/auth/analytics.readonly',
+    # Read-only access to Google Webmasters data.
+    'https://www.googleapis.com/auth/webmasters.readonly',
+]
+
+# Path to the service account credentials JSON file
+# used for authenticating with Google APIs.
+
+SERVICE_ACCOUNT_FILE = 'E:\\Path\\Placeholder\\ServiceAccountFile.json'
+
+# The ID of the Google Sheet where the data will be written.
+SHEET_ID = '1ABc-dEFGhI-Jkl34--mNoPQ'
+
+# Name of the specific worksheet within the Google Sheet where data will be stored.
+SHEET_NAME = '2024'
+
+# The Google Analytics 4 property ID from which the data will be fetched.
+GA4_PROPERTY_ID = 'properties/123456789'
+
+# Path to the on-disk cache of GA4 and Search Console responses. Reports
+# for closed months never change, so re-runs can be served from disk
+# instead of going back to the network.
+CACHE_FILE = 'E:\\Path\\Placeholder\\cache.sqlite'
+
+# Cache mode, controlled by the GA_PIPELINE_CACHE environment variable:
+#   'readwrite' - serve from the cache when possible, store fresh
+#                 responses (default).
+#   'record'    - always call the APIs and refresh the cache.
+#   'replay'    - only serve from the cache; a miss raises an error, so a
+#                 replay run is guaranteed to issue zero API calls.
+#   'off'       - bypass the cache entirely.
+CACHE_MODE = os.environ.get('GA_PIPELINE_CACHE', 'readwrite')
+
+# How long a cached response for a still-open date range stays valid,
+# in seconds. Closed date ranges never expire.
+CACHE_OPEN_RANGE_TTL = 300
+
+# Path to the JSON sidecar that persists the worksheet-title-to-sheetId
+# map across invocations. A worksheet keeps its numeric sheetId for its
+# whole life, so later runs can skip the metadata fetch entirely.
+SHEET_META_FILE = 'E:\\Path\\Placeholder\\cache_sheetid.json'
+
+# HTTP status codes treated as transient: rate limiting and server-side
+# errors that typically succeed on a later attempt.
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503)
+
+# Traffic channels reported to the sheet, mapped to their column order.
+CHANNEL_IDX = {
+    'Organic Social': 0,
+    'Direct': 1,
+    'Organic Search': 2,
+    'Referral': 3,
+}
+
+# Custom events reported to the sheet, mapped to their output order.
+EVENT_IDX = {
+    'user_spent_2_minutes': 0,
+    'bli_medlem_klick': 1,
+}
+
+# Logging configuration. Records go onto an in-memory queue and are
+# written to the log file by a background listener thread, so disk I/O on
+# the log never blocks the pipeline itself.
+
+_log_queue = queue.SimpleQueue()
+
+_log_file_handler = logging.FileHandler(
+    'E:\\Path\\Placeholder\\data_integration.log'
+)
+_log_file_handler.setFormatter(
+    logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
+)
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    handlers=[QueueHandler(_log_queue)]
+)
+
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+_log_listener.start()
+
+# Stopping the listener at interpreter exit flushes any queued records.
+atexit.register(_log_listener.stop)
+
+# Lazily initialized Google API clients. Constructing a client runs
+# service discovery, a TLS handshake, and an OAuth token exchange, so the
+# clients are created once on first use and then shared across all calls.
+
+_ga_client = None
+_sheets_service = None
+_search_console_service = None
+
+
+# Function to get the shared Google Analytics Data client.
+def get_ga_client(credentials):
+    global _ga_client
+    # Creating the client only on first use; later calls reuse the
+    # existing channel and credentials. The gRPC transport is requested
+    # explicitly so responses arrive as binary protobuf over one HTTP/2
+    # channel rather than JSON over REST.
+    if _ga_client is None:
+        _ga_client = BetaAnalyticsDataClient(
+            credentials=credentials, transport='grpc'
+        )
+    return _ga_client
+
+
+# Function to get the shared Google Sheets service.
+def get_sheets_service(credentials):
+    global _sheets_service
+    # Creating the service only on first use.
+    if _sheets_service is None:
+        # Using the discovery document bundled with the client library
+        # instead of downloading it, which saves a round-trip on startup.
+        _sheets_service = build(
+            'sheets', 'v4', credentials=credentials,
+            static_discovery=True, cache_discovery=False
+        )
+    return _sheets_service
+
+
+# Function to get the shared Google Search Console service.
+def get_search_console_service(credentials):
+    global _search_console_service
+    # Creating the service only on first use.
+    if _search_console_service is None:
+        # Using the bundled discovery document here as well.
+        _search_console_service = build(
+            'searchconsole', 'v1', credentials=credentials,
+            static_discovery=True, cache_discovery=False
+        )
+    return _search_console_service
+
+
+# Function to decide whether an API error is worth retrying.
+def is_transient_error(error):
+    # googleapiclient wraps REST errors in HttpError, with the status on
+    # the attached response.
+    if isinstance(error, HttpError):
+        return error.resp.status in TRANSIENT_STATUS_CODES
+    # The GA4 client raises google-api-core exceptions, which carry the
+    # equivalent HTTP status code directly.
+    if isinstance(error, GoogleAPICallError):
+        return error.code in TRANSIENT_STATUS_CODES
+    return False
+
+
+# Shared retry policy for all Google API calls: transient failures back
+# off exponentially with jitter for up to five attempts, after which the
+# original exception propagates to the caller's error handling. Anything
+# non-transient propagates immediately.
+retry_transient = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+
+# Function to execute a googleapiclient request under the shared retry
+# policy. Used for the individual Sheets calls, where retrying a whole
+# function could repeat a write that already succeeded.
+@retry_transient
+def execute_with_retry(request):
+    return request.execute()
+
+
+# Cached spreadsheet metadata, mapping each worksheet title to its numeric
+# sheetId. Fetched once per process so later writes do not need their own
+# metadata round-trips.
+_sheet_meta = None
+
+
+# Function to get the cached spreadsheet metadata.
+def get_sheet_meta(credentials, spreadsheet_id):
+    global _sheet_meta
+    # Trying the sidecar file first, so repeat invocations skip the
+    # metadata round-trip entirely.
+    if _sheet_meta is None:
+        try:
+            with open(SHEET_META_FILE) as sidecar:
+                _sheet_meta = json.load(sidecar)['sheet_ids']
+        except (OSError, ValueError, KeyError):
+            # A missing or unreadable sidecar just means the metadata
+            # has to be fetched from the API below.
+            pass
+    # Fetching the metadata from the API, restricted to the few
+    # properties the pipeline actually needs.
+    if _sheet_meta is None:
+        spreadsheet = execute_with_retry(
+            get_sheets_service(credentials).spreadsheets().get(
+                spreadsheetId=spreadsheet_id,
+                fields='sheets.properties(sheetId,title)'
+            )
+        )
+        _sheet_meta = {
+            sheet['properties']['title']: sheet['properties']['sheetId']
+            for sheet in spreadsheet.get('sheets', [])
+        }
+        # Persisting the map so later invocations can skip the fetch.
+        try:
+            with open(SHEET_META_FILE, 'w') as sidecar:
+                json.dump(
+                    {
+                        'sheet_ids': _sheet_meta,
+                        'fetched_at': datetime.datetime.now().isoformat(),
+                    },
+                    sidecar
+                )
+        except OSError:
+            # Failing to persist the sidecar is not fatal; the next run
+            # simply fetches the metadata again.
+            pass
+    return _sheet_meta
+
+
+# Function to drop the cached sheetId map, both in memory and on disk,
+# after the API rejects a request that used a stale sheetId.
+def invalidate_sheet_meta():
+    global _sheet_meta
+    _sheet_meta = None
+    try:
+        os.remove(SHEET_META_FILE)
+    except OSError:
+        pass
+
+
+# Function to look up a worksheet's numeric sheetId by title.
+def lookup_sheet_id(credentials, spreadsheet_id, sheet_name):
+    sheet_meta = get_sheet_meta(credentials, spreadsheet_id)
+    if sheet_name not in sheet_meta:
+        # The sidecar may predate a newly added worksheet (e.g. a new
+        # year's tab); refetching the metadata once before giving up.
+        invalidate_sheet_meta()
+        sheet_meta = get_sheet_meta(credentials, spreadsheet_id)
+    try:
+        return sheet_meta[sheet_name]
+    except KeyError:
+        # Raising a clear error instead of letting a later API call fail
+        # with a less obvious message.
+        raise KeyError(
+            f"Worksheet '{sheet_name}' not found in the spreadsheet; "
+            f"available worksheets: {sorted(sheet_meta)}"
+        ) from None
+
+
+# Shared connection to the cache database, guarded by a lock: the cached
+# fetches run in worker threads, and a sqlite3 connection must not be
+# used from two threads at once.
+_cache_db = None
+_cache_db_lock = threading.Lock()
+
+
+# Function to get the shared cache database connection.
+def get_cache_db():
+    global _cache_db
+    # Opening the database and creating the table only on first use. The
+    # lock keeps two threads from racing to create the connection, and
+    # check_same_thread is disabled because the connection outlives the
+    # worker thread that happened to create it; every use of it is
+    # serialized behind the same lock.
+    with _cache_db_lock:
+        if _cache_db is None:
+            _cache_db = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+            _cache_db.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(key TEXT PRIMARY KEY, created REAL, payload BLOB)'
+            )
+            _cache_db.commit()
+    return _cache_db
+
+
+# Decorator that caches a fetch function's return value on disk, keyed by
+# a SHA256 hash of its request parameters. The decorated function must
+# take (credentials, target, start_date, end_date); the credentials are
+# deliberately not part of the key.
+def cached_fetch(kind):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(credentials, target, start_date, end_date):
+            # Bypassing the cache entirely when disabled.
+            if CACHE_MODE == 'off':
+                return func(credentials, target, start_date, end_date)
+
+            # Building a deterministic key from the request parameters.
+            key = hashlib.sha256(json.dumps(
+                {
+                    'kind': kind,
+                    'target': target,
+                    'start': start_date,
+                    'end': end_date,
+                },
+                sort_keys=True
+            ).encode()).hexdigest()
+
+            db = get_cache_db()
+
+            # Looking for a usable cached response, unless this run is
+            # explicitly re-recording. The lock serializes access to the
+            # shared connection from the fetch worker threads.
+            if CACHE_MODE != 'record':
+                with _cache_db_lock:
+                    row = db.execute(
+                        'SELECT created, payload FROM responses WHERE key = ?',
+                        (key,)
+                    ).fetchone()
+                if row is not None:
+                    created, payload = row
+                    # A date range that ended before the current month is
+                    # closed and its report is immutable; an open range is
+                    # only trusted for a short window. ISO dates compare
+                    # correctly as strings.
+                    closed = (
+                        end_date
+                        < datetime.date.today().replace(day=1).isoformat()
+                    )
+                    if closed or time.time() - created < CACHE_OPEN_RANGE_TTL:
+                        return pickle.loads(payload)
+
+            # In replay mode a miss is an error rather than an API call.
+            if CACHE_MODE == 'replay':
+                raise LookupError(
+                    f"No cached {kind} response for "
+                    f"{start_date}..{end_date} in replay mode"
+                )
+
+            # Fetching fresh data and storing it for later runs. The
+            # fetch itself runs outside the lock so one slow API call
+            # cannot block the other worker's cache access.
+            result = func(credentials, target, start_date, end_date)
+            with _cache_db_lock:
+                db.execute(
+                    'INSERT OR REPLACE INTO responses (key, created, payload) '
+                    'VALUES (?, ?, ?)',
+                    (key, time.time(), pickle.dumps(result))
+                )
+                db.commit()
+            return result
+        return wrapper
+    return decorator
+
+
+# GA4 accepts at most four date ranges per report request.
+MAX_DATE_RANGES = 4
+
+
+# Function to map a response row to the global index of the date range it
+# belongs to.
+def row_range_slot(row, range_count, chunk_start):
+    # With a single date range GA4 adds no dateRange dimension and every
+    # row belongs to that range.
+    if range_count == 1:
+        return chunk_start
+    # With several ranges the range name ("range_<n>") arrives as the
+    # last dimension value of each row.
+    return int(row.dimension_values[-1].value.rsplit('_', 1)[1])
+
+
+# Function to fetch GA4 data for one or more date ranges, e.g. when
+# backfilling several months of rows. The ranges are chunked into groups
+# of four (the per-request maximum), so a whole year of months costs
+# three API calls instead of twelve. The fetch is read-only, so it can be
+# retried safely on transient failures.
+@retry_transient
+def fetch_ga4_data_ranges(credentials, property_id, ranges):
+    # Getting the shared Google Analytics Data client.
+    ga_client = get_ga_client(credentials)
+
+    # One result slot per requested range, filled in chunk by chunk.
+    results = [None] * len(ranges)
+
+    for chunk_start in range(0, len(ranges), MAX_DATE_RANGES):
+        chunk = ranges[chunk_start:chunk_start + MAX_DATE_RANGES]
+
+        # Naming each range after its global position, so response rows
+        # can be routed straight to the right result slot.
+        date_ranges = [
+            DateRange(
+                start_date=start_date,
+                end_date=end_date,
+                name=f'range_{chunk_start + i}'
+            )
+            for i, (start_date, end_date) in enumerate(chunk)
+        ]
+
+        # Constructing request for metrics.
+        totals_request = RunReportRequest(
+            property=property_id,
+            metrics=[
+                Metric(name='activeUsers'),  # Total number of active users.
+                Metric(name='newUsers'),  # Total number of new users.
+                Metric(name='eventCount'),  # Total number of events.
+                Metric(name='userEngagementDuration'),  # Total engagement time.
+            ],
+            # Date ranges for the data request.
+            date_ranges=date_ranges,
+            # Without dimensions the report has exactly one row per
+            # range, so anything beyond that is never read.
+            limit=len(date_ranges),
+            # No quota accounting is read from the response either.
+            return_property_quota=False
+        )
+
+        # Request to fetch the number of engaged sessions by different channels.
+        channels_request = RunReportRequest(
+            property=property_id,
+            dimensions=[Dimension(name='sessionDefaultChannelGroup')],
+            metrics=[Metric(name='engagedSessions')],
+            date_ranges=date_ranges
+        )
+
+        # Request to fetch the number of active users for custom events.
+        events_request = RunReportRequest(
+            property=property_id,
+            dimensions=[Dimension(name='eventName')],
+            metrics=[Metric(name='activeUsers')],
+            date_ranges=date_ranges,
+            dimension_filter={
+                'filter': {
+                    'field_name': 'eventName',
+                    'in_list_filter': {
+                        'values': list(EVENT_IDX)
+                    }
+                }
+            }
+        )
+
+        # Executing all three requests in a single API call, so one
+        # network round-trip covers the whole chunk of ranges.
+        batch_response = ga_client.batch_run_reports(BatchRunReportsRequest(
+            property=property_id,
+            requests=[totals_request, channels_request, events_request]
+        ))
+
+        # Accumulators for this chunk, indexed by global range slot.
+        totals = {
+            chunk_start + i: [0, 0, 0, 0] for i in range(len(chunk))
+        }
+        channel_counts = {
+            chunk_start + i: array('q', [0] * len(CHANNEL_IDX))
+            for i in range(len(chunk))
+        }
+        event_counts = {
+            chunk_start + i: array('q', [0] * len(EVENT_IDX))
+            for i in range(len(chunk))
+        }
+
+        # Totals report: one row per range that has data; ranges without
+        # data keep their zero defaults.
+        for row in batch_response.reports[0].rows:
+            slot = row_range_slot(row, len(chunk), chunk_start)
+            totals[slot] = [int(value.value) for value in row.metric_values]
+
+        # Engaged sessions per channel, accumulated into a compact
+        # integer array indexed by the precomputed channel order; rows
+        # for channels outside the map are skipped.
+        for row in batch_response.reports[1].rows:
+            idx = CHANNEL_IDX.get(row.dimension_values[0].value)
+            if idx is not None:
+                slot = row_range_slot(row, len(chunk), chunk_start)
+                channel_counts[slot][idx] += int(row.metric_values[0].value)
+
+        # User counts per custom event, accumulated the same way.
+        for row in batch_response.reports[2].rows:
+            idx = EVENT_IDX.get(row.dimension_values[0].value)
+            if idx is not None:
+                slot = row_range_slot(row, len(chunk), chunk_start)
+                event_counts[slot][idx] += int(row.metric_values[0].value)
+
+        # Assembling the per-range result tuples in the established shape.
+        for slot in totals:
+            users, new_users, events, engagement_time = totals[slot]
+            results[slot] = (
+                users, new_users, events, engagement_time,
+                channel_counts[slot].tolist(),
+                # The event counts in the order defined by EVENT_IDX.
+                event_counts[slot][0], event_counts[slot][1],
+            )
+
+    return results
+
+
+# Function to fetch data from GA4 for a single date range.
+@cached_fetch('ga4')
+def fetch_ga4_data(credentials, property_id, start_date, end_date):
+    # Delegating to the multi-range fetch with a one-element list and
+    # unpacking its single result.
+    return fetch_ga4_data_ranges(
+        credentials, property_id, [(start_date, end_date)]
+    )[0]
+
+
+# Function to fetch data from Google Search Console. Read-only, so the
+# whole function can be retried safely on transient failures.
+@cached_fetch('search_console')
+@retry_transient
+def fetch_search_console_data(credentials, site_url, start_date, end_date):
+    # Getting the shared Google Search Console service.
+    search_console_service = get_search_console_service(credentials)
+
+    # Defining the request parameters for the Search Console API query.
+    request = {
+        'startDate': start_date,
+        'endDate': end_date,
+        # No dimensions to collect aggregate data.
+        'dimensions': [],
+        # Letting the API determine the best aggregation method.
+        'aggregationType': 'auto',
+        # Limiting the number of rows returned by the API to 1000.
+        'rowLimit': 1000
+    }
+    
+    # Executing the API query, asking the server to return only the four
+    # metric fields that are actually read from the response.
+    response = search_console_service.searchanalytics().query(
+        siteUrl=site_url,
+        body=request,
+        fields='rows(clicks,impressions,ctr,position)'
+    ).execute()
+
+    if 'rows' in response:
+        # Extracting the first (and only) row of data.
+        totals = response['rows'][0]
+        # Returning the relevant metrics from the response.
+        return (
+            totals['clicks'],
+            totals['impressions'],
+            totals['ctr'],
+            totals['position']
+        )
+    else:
+        # Returning zeros for all metrics if no data is available.
+        return 0, 0, 0, 0
+
+
+# Function to write data to Google Sheets and format CTR.
+def write_and_format_data(credentials, sheet_id, sheet_name, data):
+    # Getting the shared Google Sheets service.
+    sheet_service = get_sheets_service(credentials)
+
+    # The "sheetId" used in Google Sheets API is a unique identifier
+    # assigned to each sheet within a spreadsheet. It is an integer that
+    # remains consistent for a sheet even if the order of sheets is changed
+    # within the spreadsheet.
+
+    # Looking up the worksheet's numeric sheetId in the cached
+    # spreadsheet metadata.
+    sheet_id_num = lookup_sheet_id(credentials, sheet_id, sheet_name)
+
+    # Constructing the request body with the new row of data.
+    body = {
+        'values': [data],
+        'majorDimension': 'ROWS'
+    }
+
+    # Appending the row. The server finds the position after the last row
+    # with data itself and reports the written range back, so no read
+    # round-trip is needed, and two overlapping runs cannot both pick the
+    # same row.
+    response = execute_with_retry(
+        sheet_service.spreadsheets().values().append(
+            spreadsheetId=sheet_id,
+            range=f"{sheet_name}!A:A",
+            valueInputOption='USER_ENTERED',
+            insertDataOption='INSERT_ROWS',
+            body=body,
+            fields='updates.updatedRange'
+        )
+    )
+
+    # Parsing the row number of the appended row out of a range like
+    # "'2024'!A42:N42".
+    updated_range = response['updates']['updatedRange']
+    next_row = int(updated_range.split('!A')[1].split(':')[0])
+
+    # Defining a request to format the CTR (Click Through Rate) as a percentage.
+    requests = [{
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id_num,  # ID of the sheet.
+                'startRowIndex': next_row - 1,  # Starting at the current row.
+                'endRowIndex': next_row,  # Ending at the next row.
+                'startColumnIndex': 13,  # Starting at column N.
+                'endColumnIndex': 14  # Ending at column O.
+            },
+            'cell': {
+                'userEnteredFormat': {
+                    'numberFormat': {
+                        # Setting number format type to percent.
+                        'type': 'PERCENT',
+                        # Defining the percent format to one decimal place.
+                        'pattern': '#0.0%'
+                    }
+                }
+            },
+            'fields': 'userEnteredFormat.numberFormat'
+        }
+    }]
+
+    # Executing the formatting request. The reply payload is not used, so
+    # only the spreadsheet ID is requested.
+    body = {'requests': requests}
+    try:
+        execute_with_retry(sheet_service.spreadsheets().batchUpdate(
+            spreadsheetId=sheet_id, body=body, fields='spreadsheetId'
+        ))
+    except HttpError as e:
+        # A sheetId that went stale in the sidecar (e.g. the worksheet
+        # was deleted and recreated) surfaces as a bad request. Dropping
+        # the cache, looking the sheetId up again and retrying once.
+        if e.resp.status != 400:
+            raise
+        invalidate_sheet_meta()
+        sheet_id_num = lookup_sheet_id(credentials, sheet_id, sheet_name)
+        requests[0]['repeatCell']['range']['sheetId'] = sheet_id_num
+        execute_with_retry(sheet_service.spreadsheets().batchUpdate(
+            spreadsheetId=sheet_id, body=body, fields='spreadsheetId'
+        ))
+
+
+# Function to unpack a future's result, logging the exception instead of
+# raising if the underlying fetch failed.
+def safe_result(future):
+    try:
+        return future.result(), None
+    except Exception as e:
+        # Logging any exceptions that occurred during the fetching process.
+        logging.error("Failed to complete operation", exc_info=True)
+        return None, e
+
+
+# Function to run one monthly report: fetch, transform, write.
+def run_pipeline(credentials):
+    # Getting the current date from the system clock.
+    today = datetime.date.today()
+
+    # URL for analytics data.
+    site_url = 'https://www.ideellmarknadsforing.se/'
+
+    # Computing the first and last day of the previous month.
+    first_day_last_month = (today.replace(day=1)
+                            - datetime.timedelta(days=1)).replace(day=1)
+    last_day_last_month = today.replace(day=1) - datetime.timedelta(days=1)
+
+    # Formatting the month and year (e.g., "May 2024").
+    month_and_year = (
+        f"{month_name[first_day_last_month.month]} {first_day_last_month.year}"
+    )
+
+    # Formatting the date range as "YYYY-MM-DD" strings once, up front;
+    # both fetch calls reuse the same pair.
+    start_date = first_day_last_month.isoformat()
+    end_date = last_day_last_month.isoformat()
+
+    # Logging the beginning of the data fetching process.
+    logging.info("Fetching Google Analytics and Search Console data")
+
+    # Initializing variables with default values to handle cases where
+    # data might not be fetched.
+
+    users = new_users = events = engagement_time = 0
+    eng_session_per_channel = []
+    formatted_avg_engagement_time = 0
+    user_spent_2_minutes_user_count = bli_medlem_klick_user_count = 0
+    clicks = impressions = ctr = position = 0
+
+    # The two fetches hit independent services and spend their time
+    # waiting on the network, so they are run concurrently; the wall time
+    # is that of the slower call instead of the sum of both.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ga4_future = executor.submit(
+            fetch_ga4_data,
+            # Authentication credentials.
+            credentials,
+            # Google Analytics property ID.
+            GA4_PROPERTY_ID,
+            # Start date formatted as string.
+            start_date,
+            # End date formatted as string.
+            end_date
+        )
+        gsc_future = executor.submit(
+            fetch_search_console_data,
+            # Authentication credentials.
+            credentials,
+            # URL of the website for which to fetch Search Console data.
+            site_url,
+            # Start date formatted as string.
+            start_date,
+            # End date formatted as string.
+            end_date
+        )
+
+    # Unpacking the Google Analytics result; failures were already logged.
+    ga4_result, ga4_error = safe_result(ga4_future)
+    if ga4_error is None:
+        (users, new_users, events, engagement_time,
+         eng_session_per_channel, user_spent_2_minutes_user_count,
+         bli_medlem_klick_user_count) = ga4_result
+
+        # Logging success if data fetching was completed without any exceptions.
+        logging.info("Operation was successful")
+        logging.info("GA4 data fetched: users=%s, "
+                     "new_users=%s, "
+                     "events=%s, "
+                     "eng_session_per_channel=%s",
+                     users, new_users, events, eng_session_per_channel)
+        logging.info("user_spent_2_minutes=%s, "
+                     "bli_medlem_klick=%s",
+                     user_spent_2_minutes_user_count,
+                     bli_medlem_klick_user_count)
+
+    # Unpacking the Search Console result; failures were already logged.
+    gsc_result, gsc_error = safe_result(gsc_future)
+    if gsc_error is None:
+        clicks, impressions, ctr, position = gsc_result
+
+        # Logging success if data fetching was completed without any exceptions.
+        logging.info("Operation was successful")
+        logging.info("GSC data fetched: clicks=%s, "
+                     "impressions=%s, "
+                     "ctr=%s, "
+                     "position=%s",
+                     clicks, impressions, ctr, position)
+
+    # Preparing data to be written.
+
+    # Logging the beginning of the average engagement time calculation.
+    logging.info("Calculating average engagement time in minutes:seconds")
+
+    try:
+        # Calculating the average engagement time in seconds. Both the
+        # total engagement time and the user count are integers, so the
+        # whole calculation stays in integer arithmetic.
+        if users:
+            # Splitting the per-user average into minutes and seconds.
+            minutes, seconds = divmod(engagement_time // users, 60)
+
+            # Formatting the average engagement time as "minutes:seconds".
+            formatted_avg_engagement_time = f"{minutes}:{seconds:02d}"
+        else:
+            # No users means no engagement to average.
+            formatted_avg_engagement_time = "0:00"
+            
+        # Logging success message with the calculated average engagement time.
+        logging.info("Operation was successful")
+        logging.info(
+            "Average engagement time: formatted_avg_engagement_time=%s",
+            formatted_avg_engagement_time
+        )
+
+    except Exception as e:
+        # Logging an error if there is an exception during the calculation process.
+        logging.error("Failed to complete operation", exc_info=True)
+
+    # Preparing the list of data to be written.
+    data_to_write = (
+        [
+            month_and_year,  # The reporting month and year.
+            users,  # Total number of users.
+            new_users,  # Total number of new users.
+            events,  # Total number of events.
+            formatted_avg_engagement_time,  # Formatted average engagement time.
+        ]
+        + eng_session_per_channel  # Appending engagement sessions per channel data.
+        + [
+            # Number of users who spent at least 2 minutes on the site.
+            user_spent_2_minutes_user_count,
+            # Number of users who clicked the button "Bli medlem".
+            bli_medlem_klick_user_count,
+            # Total number of clicks from Search Console.
+            clicks,
+            # Total number of impressions from Search Console.
+            impressions,
+            # Click-through rate from Search Console.
+            ctr,
+            # Rounded average position from Search Console.
+            round(position, 1),
+        ]
+    )
+
+    # Logging the initiation of the data writing process to Google Sheets.
+    logging.info("Writing to Google Sheets")
+
+    try:
+        # Attempting to write and format the data in Google Sheets.
+        write_and_format_data(credentials, SHEET_ID, SHEET_NAME, data_to_write)
+
+        # Logging a success message if data writing and formatting
+        # complete successfully.
+        logging.info("Operation was successful")
+
+    except Exception as e:
+        # Logging an error message if an exception occurs during
+        # the write operation, including traceback information.
+        logging.error("Failed to complete operation", exc_info=True)
+
+
+def main():
+    # Loading service account credentials from JSON file with specified
+    # scopes, once for the life of the process. Parsing the JSON and
+    # importing the RSA private key is relatively expensive, and the
+    # clients refresh their access tokens in place, so the file never
+    # needs to be re-read.
+    credentials = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_FILE,
+        scopes=SCOPES
+    )
+
+    # A manual run with --once executes the pipeline immediately and
+    # exits, which is convenient for testing and backfills.
+    if '--once' in sys.argv:
+        run_pipeline(credentials)
+        return
+
+    # Running as a long-lived process with an in-process scheduler
+    # replaces the external task scheduler: the credentials and the API
+    # clients are built once and reused by every monthly run.
+    scheduler = BlockingScheduler()
+    scheduler.add_job(
+        run_pipeline,
+        # Firing at 01:00 on the first day of each month.
+        CronTrigger(day=1, hour=1),
+        args=[credentials]
+    )
+    logging.info("Scheduler started, running on the 1st of each month")
+    scheduler.start()
+
+
+# If the script is executed as the main program, calling the main function.
+if __name__ == '__main__':
+    main()